@@ -52,7 +52,8 @@ def ffprobe_cmd(params):
     """
     command = ["ffprobe"] + params
 
-    pipe = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # Only stdout is read. Errors are part of the JSON output through '-show_error'
+    pipe = subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
     out, err = pipe.communicate()
 
     # Check for results
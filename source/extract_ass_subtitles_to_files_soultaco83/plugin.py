@@ -19,11 +19,10 @@
         If not, see <https://www.gnu.org/licenses/>.
 
 """
+import functools
 import logging
 import os
 import re
-import glob
-import shutil
 
 from unmanic.libs.unplugins.settings import PluginSettings
 from unmanic.libs.directoryinfo import UnmanicDirectoryInfo
@@ -33,6 +32,12 @@ from extract_ass_subtitles_to_files_soultaco83.lib.ffmpeg import StreamMapper, P
 # Configure plugin logger
 logger = logging.getLogger("Unmanic.Plugin.extract_ass_subtitles_to_files_soultaco83")
 
+# Whitespace in the configured language list is replaced with '-'
+_WS_RE = re.compile(r'\s+')
+
+# Subtitle codecs extracted by this plugin
+_ASS_CODECS = frozenset({'ass', 'ssa'})
+
 class Settings(PluginSettings):
     settings = {
         "languages_to_extract": "",
@@ -51,28 +56,79 @@ class Settings(PluginSettings):
             },
         }
 
+@functools.lru_cache(maxsize=256)
+def _cached_probe(path, mtime):
+    """
+    Probe a file once per modification time.
+    The mtime argument is not used here, it only exists to invalidate the cache when the file changes.
+    """
+    probe = Probe(logger, allowed_mimetypes=['video'])
+    if not probe.file(path):
+        return None
+    return probe
+
+def get_probe(path):
+    """
+    Return a Probe for the given path, re-using the result of a previous ffprobe run if the file has not changed.
+    Returns None if the file does not exist or is not a video file.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        logger.debug("File does not exist - '%s'", path)
+        return None
+    return _cached_probe(path, mtime)
+
+@functools.lru_cache(maxsize=128)
+def _cached_directory_info(directory, mtime_ns, size):
+    """
+    Parse a directory's .unmanic file once per modification.
+    The mtime_ns and size arguments are not used here, they only exist to invalidate the cache when the file changes.
+    """
+    return UnmanicDirectoryInfo(directory)
+
+def get_directory_info(directory):
+    """
+    Return the UnmanicDirectoryInfo for a directory, re-using the previous parse of its .unmanic file if it has not changed.
+    Returns None if the directory has no .unmanic file.
+    Only use this for reads. Updates should load a fresh UnmanicDirectoryInfo so they do not save over changes made elsewhere.
+    """
+    try:
+        stat = os.stat(os.path.join(directory, '.unmanic'))
+    except FileNotFoundError:
+        return None
+    return _cached_directory_info(directory, stat.st_mtime_ns, stat.st_size)
+
 class PluginStreamMapper(StreamMapper):
     def __init__(self):
         super(PluginStreamMapper, self).__init__(logger, ['subtitle'])
-        self.sub_streams = []
+        # Parallel lists of the subtitle streams to extract
+        self.sub_stream_ids = []
+        self.sub_stream_tags = []
+        self.sub_stream_mappings = []
         self.settings = None
+        self._languages = frozenset()
         logger.debug("PluginStreamMapper initialized.")
 
     def set_settings(self, settings):
         self.settings = settings
         logger.debug("Settings have been set in PluginStreamMapper: %s", settings)
+        self._languages = self._parse_language_list()
 
-    def _get_language_list(self):
+    def _parse_language_list(self):
         language_list = self.settings.get_setting('languages_to_extract')
-        language_list = re.sub(r'\s', '-', language_list)
-        languages = list(filter(None, language_list.lower().split(',')))
+        language_list = _WS_RE.sub('-', language_list)
+        languages = frozenset(language.strip() for language in language_list.lower().split(',') if language)
         logger.debug("Languages to extract: %s", languages)
-        return [language.strip() for language in languages]
+        return languages
+
+    def _get_language_list(self):
+        return self._languages
 
     def test_stream_needs_processing(self, stream_info: dict):
         """Any text-based subtitles will need to be processed"""
         codec_name = stream_info.get('codec_name', '').lower()
-        if codec_name not in ['ass', 'ssa']:
+        if codec_name not in _ASS_CODECS:
             logger.debug("Stream %s does not require processing (codec: %s).", stream_info.get('index'), codec_name)
             return False
 
@@ -82,7 +138,7 @@ class PluginStreamMapper(StreamMapper):
         logger.debug("Checking if stream with language '%s' needs processing.", language_tag)
 
         # If no languages specified, extract all
-        if len(languages) == 0:
+        if not languages:
             logger.debug("No specific languages set; all subtitle streams will be processed.")
             return True
 
@@ -103,7 +159,7 @@ class PluginStreamMapper(StreamMapper):
         languages = self._get_language_list()
         
         # Skip stream if not in the specified languages
-        if len(languages) > 0 and language_tag not in languages:
+        if languages and language_tag not in languages:
             logger.debug("Stream ID %d with language '%s' is not in the extraction list; skipping mapping.", stream_id, language_tag)
             return {
                 'stream_mapping':  [],
@@ -116,24 +172,21 @@ class PluginStreamMapper(StreamMapper):
         logger.debug("Generated subtitle tag '%s' for stream ID %d.", subtitle_tag, stream_id)
         
         # Use a more robust stream specifier
-        stream_specifier = f'0:s:{stream_id}?'
+        stream_mapping = ['-map', f'0:s:{stream_id}?']
         
         # Add the stream to the list
-        self.sub_streams.append(
-            {
-                'stream_id': stream_id,
-                'subtitle_tag': subtitle_tag,
-                'stream_mapping': ['-map', stream_specifier],
-            }
-        )
+        self.sub_stream_ids.append(stream_id)
+        self.sub_stream_tags.append(subtitle_tag)
+        self.sub_stream_mappings.append(stream_mapping)
         logger.debug("Added stream ID %d to sub_streams with tag '%s'.", stream_id, subtitle_tag)
         
         # Copy the streams to the destination
         mapping = {
-            'stream_mapping': ['-map', stream_specifier],
-            'stream_encoding': ['-c:s:{}'.format(stream_id), 'copy'],
+            'stream_mapping': stream_mapping,
+            'stream_encoding': [f'-c:s:{stream_id}', 'copy'],
         }
-        logger.debug("Stream mapping for stream ID %d: %s", stream_id, mapping)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Stream mapping for stream ID %d: %s", stream_id, mapping)
         return mapping
 
     def get_ffmpeg_args(self):
@@ -141,47 +194,89 @@ class PluginStreamMapper(StreamMapper):
         Overwrite default function. We only need the first lot of args.
         :return: list of ffmpeg arguments
         """
-        args = []
-
-        # Add generic options first
-        args += self.generic_options
-        logger.debug("Added generic options: %s", self.generic_options)
-
-        # Add the input file
         if not self.input_file:
             logger.error("Input file has not been set in PluginStreamMapper.")
             raise Exception("Input file has not been set")
-        args += ['-i', self.input_file]
-        logger.debug("Added input file to ffmpeg args: %s", self.input_file)
-
-        # Add other main options
-        args += self.main_options
-        logger.debug("Added main options: %s", self.main_options)
 
-        # Add advanced options (stream mapping and encoding args)
-        args += self.advanced_options
-        logger.debug("Added advanced options: %s", self.advanced_options)
+        # Generic options first, then the input file, other main options and advanced options
+        args = [*self.generic_options, '-i', self.input_file, *self.main_options, *self.advanced_options]
 
         logger.debug("Final ffmpeg args from get_ffmpeg_args: %s", args)
         return args
 
-def ass_already_extracted(settings, path):
+def has_ass_files(base_path, infix=''):
+    """
+    Return True if any "<base_path>.<infix>*.ass" file exists.
+    Matches the same names a glob would, without glob's pattern handling of the file name.
+    """
+    directory, file_name = os.path.split(base_path)
+    prefix = file_name + '.' + infix
+    try:
+        with os.scandir(directory or '.') as entries:
+            return any(entry.name.startswith(prefix) and entry.name[len(prefix):].endswith('.ass')
+                       for entry in entries)
+    except OSError:
+        return False
+
+def get_library_file_probe(data):
+    """
+    Return a Probe for a library management file test.
+    A probe shared in 'shared_info' by an earlier file test runner is re-used. Otherwise the file is probed
+    and the result is shared with the file test runners that follow.
+    """
+    ffprobe_data = data.get('shared_info', {}).get('ffprobe')
+    if ffprobe_data:
+        probe = Probe(logger, allowed_mimetypes=['video'])
+        if not probe.set_probe(ffprobe_data):
+            return None
+        return probe
+
+    probe = get_probe(data.get('path'))
+    if probe:
+        if 'shared_info' not in data:
+            data['shared_info'] = {}
+        data['shared_info']['ffprobe'] = probe.get_probe()
+    return probe
+
+def ass_already_extracted(settings, path, load_probe=None):
+    """
+    Return True if the file does not need its ASS/SSA subtitles extracted.
+    load_probe is called without arguments to fetch the file's Probe, only once the checks that do not need one
+    have not decided. It defaults to get_probe(path).
+    """
     logger.debug("Checking if ASS/SSA is already extracted for file: %s", path)
 
+    # Only MKV files are processed. Check this before reading the .unmanic file or probing the file
+    base_path, file_extension = os.path.splitext(path)
+    file_extension = file_extension[1:].lower()
+    if file_extension and file_extension != 'mkv':
+        logger.error("File '%s' is not MKV format", path)
+        return True
+
+    if settings.get_setting('extract_regardless'):
+        logger.debug("Plugin configured to extract regardless of previous extraction for file '%s'.", path)
+        return False
+
     # Check .unmanic file if it exists
-    unmanic_file_path = os.path.join(os.path.dirname(path), '.unmanic')
-    if os.path.exists(unmanic_file_path):
-        directory_info = UnmanicDirectoryInfo(os.path.dirname(path))
-        try:
-            already_extracted = directory_info.get('extract_ass_subtitles_to_files', os.path.basename(path))
+    directory, file_name = os.path.split(path)
+    try:
+        directory_info = get_directory_info(directory)
+        if directory_info is not None:
+            already_extracted = directory_info.get('extract_ass_subtitles_to_files', file_name)
             if already_extracted:
-                logger.debug(f"File's ASS/SSA subtitle streams were previously extracted according to .unmanic file: {already_extracted}")
+                logger.debug("File's ASS/SSA subtitle streams were previously extracted according to .unmanic file: %s", already_extracted)
                 return True
-        except Exception as e:
-            logger.debug(f"Error reading .unmanic file: {str(e)}")
+    except Exception as e:
+        logger.debug("Error reading .unmanic file: %s", e)
 
-    probe = Probe(logger, allowed_mimetypes=['video'])
-    if not probe.file(path):
+    # Check for existing ASS/SSA files
+    if has_ass_files(base_path):
+        logger.debug("ASS/SSA files exist for file '%s'. Skipping extraction due to existing ASS/SSA files.", path)
+        return True
+
+    # Only probe the file once the checks above have not decided
+    probe = load_probe() if load_probe is not None else get_probe(path)
+    if not probe:
         logger.debug("File '%s' is not a video file.", path)
         return False
 
@@ -192,38 +287,17 @@ def ass_already_extracted(settings, path):
     logger.debug("ASS_SUB tag value for file '%s': '%s'", path, subs_tag)
     
     # Check if the file has ASS/SSA subtitles
-    has_target_subtitles = False
-    streams = probe.get('streams', [])
-    for stream in streams:
-        if stream.get('codec_type') == 'subtitle':
-            codec_name = stream.get('codec_name', '').lower()
-            if codec_name in ['ass', 'ssa']:
-                has_target_subtitles = True
-                break
+    has_target_subtitles = any(
+        stream.get('codec_name', '').lower() in _ASS_CODECS
+        for stream in probe.get('streams', []) if stream.get('codec_type') == 'subtitle'
+    )
 
-    # Check for existing ASS/SSA files
-    base_path = os.path.splitext(path)[0]
-    file_extension = os.path.splitext(path)[-1][1:]
-    file_extension = file_extension.lower()
-    existing_ass_files = glob.glob(f"{base_path}.*.ass")
-    if file_extension and file_extension.lower() != 'mkv':
-        logger.error(f"File '{path}' is not MKV format")
-        return True
-    elif settings.get_setting('extract_regardless'):
-        logger.debug("Plugin configured to extract regardless of previous extraction")
+    if subs_tag != 'extracted' and has_target_subtitles:
+        logger.debug("No ASS/SSA files or ASS_SUB tag, but target subtitles found for file '%s'. Proceeding with subtitle extraction.", path)
         return False
-    elif subs_tag == 'extracted' and existing_ass_files:
-        logger.debug(f"ASS/SSA subtitles have already been extracted and tagged for file '{path}'. Skipping further processing.")
-        return True
-    elif existing_ass_files:
-        logger.debug(f"ASS/SSA files exist for file '{path}'. Skipping extraction due to existing ASS/SSA files.")
-        return True
-    elif not existing_ass_files and not subs_tag == 'extracted' and has_target_subtitles:
-        logger.debug(f"No ASS/SSA files or ASS_SUB tag, but target subtitles found for file '{path}'. Proceeding with subtitle extraction.")
-        return False
-    else:
-        logger.debug(f"No ASS/SSA subtitles to extract for file '{path}'. Skipping further processing.")
-        return True
+
+    logger.debug("No ASS/SSA subtitles to extract for file '%s'. Skipping further processing.", path)
+    return True
 
 def on_library_management_file_test(data):
     """
@@ -236,24 +310,21 @@ def on_library_management_file_test(data):
     settings = Settings(library_id=data.get('library_id', None))
     logger.debug("Initialized settings with library_id: %s", data.get('library_id', None))
 
-    # Check if subtitles need to be extracted
-    if not ass_already_extracted(settings, abspath):
+    # Check if subtitles need to be extracted. The file is only probed if the cheaper checks do not decide
+    # The probe is shared with the file test runners that follow through 'shared_info'
+    if not ass_already_extracted(settings, abspath, functools.partial(get_library_file_probe, data)):
         data['add_file_to_pending_tasks'] = True
-        logger.debug(f"File '{abspath}' is added to pending tasks. It needs subtitle extraction.")
+        logger.debug("File '%s' is added to pending tasks. It needs subtitle extraction.", abspath)
     else:
-        logger.debug(f"File '{abspath}' is not added to pending tasks. No subtitle extraction needed.")
+        logger.debug("File '%s' is not added to pending tasks. No subtitle extraction needed.", abspath)
     
     return data
 
-import subprocess  # Add this import
-
 def get_unique_ass_filename(base_path, subtitle_tag, stream_index):
     """
     Generate a unique ASS/SSA filename with Unmanic prefix.
     """
-    ass_filename = f"{base_path}.unmanic.{subtitle_tag}.{stream_index}.ass"
-    logger.debug(f"Generated ASS/SSA filename: {ass_filename}")
-    return ass_filename
+    return ''.join((base_path, '.unmanic.', subtitle_tag, '.', str(stream_index), '.ass'))
 
 def on_worker_process(data):
     """
@@ -286,8 +357,8 @@ def on_worker_process(data):
     logger.debug("Processing worker process for file: %s", abspath)
 
     # Get file probe
-    probe = Probe(logger, allowed_mimetypes=['video'])
-    if not probe.file(abspath):
+    probe = get_probe(abspath)
+    if not probe:
         logger.debug("File '%s' is not a video file.", abspath)
         return data
 
@@ -295,7 +366,7 @@ def on_worker_process(data):
     settings = Settings(library_id=data.get('library_id', None))
     logger.debug("Initialized settings with library_id: %s", data.get('library_id', None))
     
-    if ass_already_extracted(settings, abspath):
+    if ass_already_extracted(settings, abspath, lambda: probe):
         logger.debug("Skipping processing for file '%s' as ASS/SSA is already extracted or no processing needed.", abspath)
         # Set exec_command to None to signal that no processing is needed
         data['exec_command'] = None
@@ -322,26 +393,22 @@ def on_worker_process(data):
         base_path = os.path.splitext(data.get('original_file_path'))[0]
         logger.debug("Base path: %s", base_path)
 
-        for sub_stream in mapper.sub_streams:
-            stream_mapping = sub_stream.get('stream_mapping', [])
-            subtitle_tag = sub_stream.get('subtitle_tag')
-            stream_index = sub_stream.get('stream_id')
-            logger.debug("Processing sub_stream: %s", sub_stream)
+        for stream_index, subtitle_tag, stream_mapping in zip(mapper.sub_stream_ids, mapper.sub_stream_tags,
+                                                              mapper.sub_stream_mappings):
+            logger.debug("Processing sub_stream %d with tag '%s'.", stream_index, subtitle_tag)
 
             # Get a unique ass filename
             output_ass = get_unique_ass_filename(base_path, subtitle_tag, stream_index)
             logger.debug("ASS filename for subtitle tag '%s': %s", subtitle_tag, output_ass)
 
-            ffmpeg_args += stream_mapping          
-            ffmpeg_args += [
-                "-y",
-                output_ass,
-            ]
-            logger.debug("Updated ffmpeg_args after adding stream mapping and output: %s", ffmpeg_args)
+            ffmpeg_args.extend(stream_mapping)
+            ffmpeg_args.append('-y')
+            ffmpeg_args.append(output_ass)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Updated ffmpeg_args after adding stream mapping and output: %s", ffmpeg_args)
 
         # Apply ffmpeg args to command
-        data['exec_command'] = ['ffmpeg']
-        data['exec_command'] += ffmpeg_args
+        data['exec_command'] = ['ffmpeg', *ffmpeg_args]
         logger.debug("Final exec_command set to: %s", data['exec_command'])
 
         # Set the parser
@@ -350,61 +417,46 @@ def on_worker_process(data):
         data['command_progress_parser'] = parser.parse_progress
         logger.debug("Command progress parser set.")
 
-        # Execute FFmpeg command
-        try:
-            result = subprocess.run(data['exec_command'], check=True, capture_output=True, text=True)
-            logger.debug("FFmpeg command executed successfully.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"FFmpeg command failed: {e}")
-            logger.debug(f"FFmpeg stderr: {e.stderr}")
-            # If the error is due to stream mapping, we can ignore it and continue
-            if "Stream map '0:s:" in e.stderr and "matches no streams" in e.stderr:
-                logger.warning("Some stream mappings failed, but continuing with metadata update.")
-            else:
-                return data  # Exit if there's an unexpected error
-        
-        # Extract file extension
-        file_extension = os.path.splitext(abspath)[-1][1:].lower()
-        logger.debug(f"File extension: {file_extension}")
-        
-        # Use the cache directory provided by Unmanic
-        cache_directory = os.path.dirname(data.get('file_out'))
-        if not os.path.exists(cache_directory):
-            os.makedirs(cache_directory)
-        logger.debug(f"Cache directory: {cache_directory}")
-        
-        # Create a temporary file in the cache directory
-        file_name = os.path.basename(abspath)
-        file_name_without_ext = os.path.splitext(file_name)[0]
-        temp_output = os.path.join(cache_directory, f"{file_name_without_ext}_temp.mkv")
-        logger.debug(f"Temporary output file: {temp_output}")
-        
-        metadata_command = [
-            'ffmpeg', '-i', abspath,
-            '-map_metadata', '0',
-            '-metadata', 'ASS_SUB=extracted',
-            '-c', 'copy',
-            '-y',
-            temp_output
-        ]
-        logger.debug("Metadata command: %s", metadata_command)
-        try:
-            logger.debug("Running metadata command for file '%s'.", abspath)
-            subprocess.run(metadata_command, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            logger.debug("Metadata command executed successfully.")
-            
-            # Replace the original file with the temporary file
-            shutil.move(temp_output, abspath)
-            logger.debug(f"Metadata 'SRT_SUB=extracted' added to {abspath} and original file replaced.")
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Failed to set metadata on {abspath}: {str(e)}")
-            if e.stderr:
-                logger.debug("ffmpeg stderr: %s", e.stderr.decode('utf-8'))
-        except OSError as oe:
-            logger.error(f"Failed to replace the original file: {str(oe)}")
-            logger.debug("OSError details: %s", str(oe))
-
     else:
         logger.debug("Streams do not need processing for file '%s'.", abspath)
 
-    return data
\ No newline at end of file
+    return data
+
+def on_postprocessor_task_results(data):
+    """
+    Runner function - provides a means for additional postprocessor functions based on the task success.
+
+    The 'data' object argument includes:
+        final_cache_path                - The path to the final cache file that was then used as the source for all destination files.
+        library_id                      - The library that the current task is associated with.
+        task_processing_success         - Boolean, did all task processes complete successfully.
+        file_move_processes_success     - Boolean, did all postprocessor movement tasks complete successfully.
+        destination_files               - List containing all file paths created by postprocessor file movements.
+        source_data                     - Dictionary containing data pertaining to the original source file.
+
+    :param data:
+    :return:
+
+    """
+    # Only mark the file as extracted if the task (including the ffmpeg command returned by the worker) succeeded
+    if not data.get('task_processing_success'):
+        logger.debug("Task was not successful; not marking files as extracted.")
+        return data
+
+    # Record the extraction in the .unmanic file of each destination file's directory.
+    # This avoids remuxing the whole file only to stamp an ASS_SUB tag on it.
+    # Only MKV files with "<base>.unmanic.*.ass" files written next to them were extracted by this plugin.
+    for destination_file in data.get('destination_files', []):
+        base_path, file_extension = os.path.splitext(destination_file)
+        if file_extension[1:].lower() != 'mkv' or not has_ass_files(base_path, 'unmanic.'):
+            logger.debug("No ASS/SSA files were extracted for '%s'; not marking it as extracted.", destination_file)
+            continue
+        try:
+            directory_info = UnmanicDirectoryInfo(os.path.dirname(destination_file))
+            directory_info.set('extract_ass_subtitles_to_files', os.path.basename(destination_file), 'extracted')
+            directory_info.save()
+            logger.debug("Marked '%s' as extracted in the .unmanic file.", destination_file)
+        except Exception as e:
+            logger.error("Failed to update the .unmanic file for '%s': %s", destination_file, e)
+
+    return data